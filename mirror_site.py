@@ -1,13 +1,30 @@
 import argparse
+import contextlib
 import hashlib
+import json
 import os
 import re
+import shutil
+import tempfile
+import threading
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache, partial
 from pathlib import Path
+from typing import Callable
 from urllib.parse import urljoin, urlsplit, urlunsplit
 
 import cloudscraper
-from bs4 import BeautifulSoup
+import requests
+from bs4 import BeautifulSoup, Tag
+from requests.adapters import HTTPAdapter
+
+try:
+    import html5_parser
+except (ImportError, RuntimeError):
+    # html5-parser raises RuntimeError when its libxml2 differs from lxml's
+    html5_parser = None
 
 ALLOWED_SCHEMES = {"http", "https"}
 ASSET_TAG_ATTRS = {
@@ -22,9 +39,22 @@ ASSET_TAG_ATTRS = {
 }
 
 LOCALISE_DOMAINS = {"uk.pandora.net", "cdn.media.amplience.net"}
+LOCALISE_HOSTS = frozenset(LOCALISE_DOMAINS)
+LOCALISE_DOT = tuple(f".{host}" for host in LOCALISE_DOMAINS)
+SKIP_LINK_PREFIXES = ("#", "javascript:", "mailto:", "tel:")
+ABSOLUTE_LINK_PREFIXES = ("http://", "https://", "//")
 URL_IN_STYLE_RE = re.compile(r"url\((['\"]?)(https?://[^'\"\)]+)\1\)")
+ABSOLUTE_URL_RE = re.compile(r"https?://[^\s'\")]+")
+DEFAULT_WORKERS = 16
+# The URL helpers below are pure and see the same inputs across every page,
+# so their results are memoised (Path is immutable, so caching it is safe)
+URL_CACHE_SIZE = 100_000
+ASSET_CACHE_FILE = ".asset_cache.json"
+COPY_CHUNK_SIZE = 1024 * 1024
+SEEN_DIRS_LOCK = threading.Lock()
 
 
+@lru_cache(maxsize=URL_CACHE_SIZE)
 def canonicalize(url: str, base: str) -> str | None:
     if not url:
         return None
@@ -39,6 +69,7 @@ def canonicalize(url: str, base: str) -> str | None:
     return urlunsplit(parsed)
 
 
+@lru_cache(maxsize=URL_CACHE_SIZE)
 def url_to_local_path(url: str, root: Path) -> Path:
     parsed = urlsplit(url)
     netloc = parsed.netloc
@@ -49,7 +80,9 @@ def url_to_local_path(url: str, root: Path) -> Path:
         path = path.rstrip("/") + "/index.html"
     local_path = root / netloc / path.lstrip("/")
     if parsed.query:
-        digest = hashlib.md5(parsed.query.encode()).hexdigest()[:8]
+        # Keep MD5 so names match the files already mirrored; it is only a
+        # filename digest, so skip the FIPS/security-checked code path
+        digest = hashlib.md5(parsed.query.encode(), usedforsecurity=False).hexdigest()[:8]
         suffix = local_path.suffix
         if suffix:
             local_path = local_path.with_suffix("")
@@ -59,93 +92,269 @@ def url_to_local_path(url: str, root: Path) -> Path:
     return local_path
 
 
-def ensure_parent(path: Path) -> None:
-    path.parent.mkdir(parents=True, exist_ok=True)
+@lru_cache(maxsize=8192)
+def cached_relpath(target: str, start: str) -> str:
+    return os.path.relpath(target, start)
+
+
+def ensure_parent(path: Path, seen_dirs: set[Path] | None = None) -> None:
+    # seen_dirs holds the directories already created during this crawl so repeat
+    # assets skip the mkdir syscall; a racing duplicate mkdir is harmless with exist_ok
+    parent = path.parent
+    if seen_dirs is not None:
+        with SEEN_DIRS_LOCK:
+            if parent in seen_dirs:
+                return
+    parent.mkdir(parents=True, exist_ok=True)
+    if seen_dirs is not None:
+        with SEEN_DIRS_LOCK:
+            seen_dirs.add(parent)
+
+
+def may_be_internal(url: str | None) -> bool:
+    # Cheap string checks that reject most off-site links before canonicalize
+    if not url or url.startswith(SKIP_LINK_PREFIXES):
+        return False
+    # Only absolute URLs can be off-site; relative ones may carry a URL in their query
+    return not url.startswith(ABSOLUTE_LINK_PREFIXES) or "pandora.net" in url
 
 
+@lru_cache(maxsize=URL_CACHE_SIZE)
 def should_localize(url: str) -> bool:
     parsed = urlsplit(url)
     domain = parsed.netloc
-    return any(domain == host or domain.endswith(f".{host}") for host in LOCALISE_DOMAINS)
+    return domain in LOCALISE_HOSTS or domain.endswith(LOCALISE_DOT)
 
 
-def localize_url(scraper, url: str, page_local: Path, asset_cache: dict[str, Path], root: Path) -> str | None:
+def localize_url(url: str, url_to_rel: dict[str, str]) -> str | None:
     if not should_localize(url):
         return None
-    local_path = download_binary(scraper, url, root, asset_cache)
-    if not local_path:
-        return None
-    return os.path.relpath(local_path, page_local.parent)
+    return url_to_rel.get(url)
+
+
+def replace_style_url(match: re.Match, url_to_rel: dict[str, str]) -> str:
+    rel = localize_url(match.group(2), url_to_rel)
+    if not rel:
+        return match.group(0)
+    quote = match.group(1)
+    return f"url({quote}{rel}{quote})"
+
+
+def localize_style_text(text: str, replace: Callable[[re.Match], str]) -> tuple[str, bool]:
+    # Skip the regex engine entirely for CSS without any url() references
+    if "url(" not in text:
+        return text, False
+    new_text, count = URL_IN_STYLE_RE.subn(replace, text)
+    return new_text, bool(count) and new_text != text
 
 
-def download_binary(scraper, url: str, root: Path, cache: dict[str, Path]) -> Path | None:
-    if url in cache:
-        return cache[url]
+def download_binary(session, url: str, root: Path, seen_dirs: set[Path] | None = None) -> Path | None:
+    local_path = url_to_local_path(url, root)
+    if local_path.exists():
+        return local_path
     try:
-        resp = scraper.get(url, stream=True, timeout=30)
-        resp.raise_for_status()
+        resp = session.get(url, stream=True, timeout=30)
     except Exception:
         return None
-    local_path = url_to_local_path(url, root)
-    ensure_parent(local_path)
-    with open(local_path, "wb") as fh:
-        for chunk in resp.iter_content(chunk_size=8192):
-            if chunk:
-                fh.write(chunk)
-    cache[url] = local_path
+    # Close the streamed response on every path so its connection goes back to the pool
+    with resp:
+        try:
+            resp.raise_for_status()
+        except Exception:
+            return None
+        ensure_parent(local_path, seen_dirs)
+        # Download to a unique sibling temp file so an interrupted run never leaves a
+        # truncated asset that the exists() check above would then trust
+        fd, part_name = tempfile.mkstemp(dir=local_path.parent, prefix=f"{local_path.name}.", suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                if resp.raw is not None:
+                    # Let urllib3 undo any gzip/deflate so the bytes match iter_content
+                    resp.raw.decode_content = True
+                    shutil.copyfileobj(resp.raw, fh, length=COPY_CHUNK_SIZE)
+                else:
+                    for chunk in resp.iter_content(chunk_size=COPY_CHUNK_SIZE):
+                        fh.write(chunk)
+            # mkstemp creates the file owner-only; mirrored assets should be world-readable
+            os.chmod(part_name, 0o644)
+            os.replace(part_name, local_path)
+        except Exception:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(part_name)
+            return None
     return local_path
 
 
-def rewrite_srcset(scraper, tag, attr, page_url: str, page_local: Path, asset_cache: dict[str, Path], root: Path):
-    raw = tag.get(attr)
-    if not raw:
-        return
-    parts = []
-    changed = False
-    for candidate in raw.split(","):
-        candidate = candidate.strip()
-        if not candidate:
+def load_asset_cache(cache_file: Path, root: Path) -> dict[str, Path | None]:
+    if not cache_file.exists():
+        return {}
+    try:
+        with open(cache_file, encoding="utf-8") as fh:
+            entries = json.load(fh)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(entries, dict):
+        return {}
+    cache: dict[str, Path | None] = {}
+    for url, local in entries.items():
+        if not isinstance(local, str):
+            continue
+        # Entries are stored relative to the output root so the tree can move
+        local_path = root / local
+        if local_path.exists():
+            cache[url] = local_path
+    return cache
+
+
+def save_asset_cache(cache_file: Path, cache: dict[str, Path | None], root: Path) -> None:
+    # Failures are left out so the next run retries them
+    entries = {
+        url: Path(os.path.relpath(local_path, root)).as_posix()
+        for url, local_path in cache.items()
+        if local_path is not None
+    }
+    ensure_parent(cache_file)
+    tmp_file = cache_file.with_name(cache_file.name + ".tmp")
+    with open(tmp_file, "w", encoding="utf-8") as fh:
+        json.dump(entries, fh)
+    os.replace(tmp_file, cache_file)
+
+
+@dataclass
+class AssetRef:
+    tag: Tag
+    attr: str
+    url: str | None = None
+    srcset: bool = False
+    # srcset entries as (original candidate, canonical url or None, descriptor)
+    candidates: list[tuple[str, str | None, str]] = field(default_factory=list)
+
+    def urls(self) -> list[str]:
+        if not self.srcset:
+            return [self.url]
+        return [canon for _, canon, _ in self.candidates if canon]
+
+
+def is_hint_link(tag) -> bool:
+    rels = {rel.lower() for rel in tag.get("rel", [])}
+    return bool({"preconnect", "dns-prefetch"} & rels)
+
+
+def asset_tag_refs(tag, tag_name: str, page_url: str) -> list[AssetRef]:
+    refs = []
+    for attr in ASSET_TAG_ATTRS[tag_name]:
+        value = tag.get(attr)
+        if not value:
             continue
-        if " " in candidate:
-            url_part, descriptor = candidate.split(" ", 1)
+        if attr in ("srcset", "data-srcset"):
+            ref = AssetRef(tag, attr, srcset=True)
+            for candidate in value.split(","):
+                candidate = candidate.strip()
+                if not candidate:
+                    continue
+                if " " in candidate:
+                    url_part, descriptor = candidate.split(" ", 1)
+                else:
+                    url_part, descriptor = candidate, ""
+                ref.candidates.append((candidate, canonicalize(url_part, page_url), descriptor))
+            refs.append(ref)
         else:
-            url_part, descriptor = candidate, ""
-        canon = canonicalize(url_part, page_url)
-        if canon:
-            local = download_binary(scraper, canon, root, asset_cache)
-            if local:
-                rel = os.path.relpath(local, page_local.parent)
-                parts.append(f"{rel} {descriptor}".strip())
-                changed = True
-                continue
-        parts.append(candidate)
-    if changed:
-        tag[attr] = ", ".join(parts)
+            canon = canonicalize(value, page_url)
+            if canon:
+                refs.append(AssetRef(tag, attr, url=canon))
+    return refs
 
 
-def handle_asset(scraper, tag, attr, tag_name: str, page_url: str, page_local: Path, asset_cache: dict[str, Path], root: Path):
-    value = tag.get(attr)
-    if not value:
-        return
-    canon = canonicalize(value, page_url)
-    if not canon:
+def apply_asset_ref(ref: AssetRef, url_to_rel: dict[str, str]) -> None:
+    if not ref.srcset:
+        rel = url_to_rel.get(ref.url)
+        if rel:
+            ref.tag[ref.attr] = rel
         return
-    if tag_name == "link":
-        rels = {rel.lower() for rel in tag.get("rel", [])}
-        if {"preconnect", "dns-prefetch"} & rels:
-            tag.decompose()
-            return
-    local = download_binary(scraper, canon, root, asset_cache)
-    if local:
-        rel = os.path.relpath(local, page_local.parent)
-        tag[attr] = rel
+    parts = []
+    changed = False
+    for candidate, canon, descriptor in ref.candidates:
+        rel = url_to_rel.get(canon) if canon else None
+        if rel:
+            parts.append(f"{rel} {descriptor}".strip())
+            changed = True
+        else:
+            parts.append(candidate)
+    if changed:
+        ref.tag[ref.attr] = ", ".join(parts)
+
+
+def style_asset_urls(text: str | None) -> list[str]:
+    if not text or "url(" not in text:
+        return []
+    return [m.group(2) for m in URL_IN_STYLE_RE.finditer(text) if should_localize(m.group(2))]
+
+
+def prefetch_assets(executor, session, urls: set[str], root: Path, cache: dict[str, Path | None], seen_dirs: set[Path]) -> None:
+    # Workers never touch the shared cache; results are merged here on the calling
+    # thread. Failures are cached as None so later pages don't retry them.
+    # URLs that map to the same file (http/https, /x and /x/) are fetched once so
+    # two workers never race on one target
+    pending: dict[Path, list[str]] = {}
+    for url in urls:
+        if url not in cache:
+            pending.setdefault(url_to_local_path(url, root), []).append(url)
+    groups = list(pending.values())
+    results = executor.map(lambda group: download_binary(session, group[0], root, seen_dirs), groups)
+    for group, local_path in zip(groups, results):
+        for url in group:
+            cache[url] = local_path
+
+
+def create_asset_session(scraper, pool_size: int) -> requests.Session:
+    # Skip cloudscraper's challenge middleware for assets and reuse pooled connections
+    # sized to the worker count. Same-origin assets on uk.pandora.net still sit behind
+    # Cloudflare, so share the scraper's cookie jar to send the clearance cookies that
+    # its page loads obtain.
+    session = requests.Session()
+    session.headers.update(scraper.headers)
+    session.cookies = scraper.cookies
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_size, max_retries=2)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def parse_html(text: str):
+    # html5-parser builds the BeautifulSoup tree in C; fall back to bs4 + lxml without it.
+    # selectolax (lexbor) parses faster still, but its nodes don't implement the
+    # BeautifulSoup API that the walk and the AssetRef/style rewrites mutate.
+    if html5_parser is not None:
+        return html5_parser.parse(text, treebuilder="soup", return_root=False)
+    return BeautifulSoup(text, "lxml")
+
+
+def crawl(start_url: str, output_root: Path, max_pages: int, follow_prefix: str | None, workers: int = DEFAULT_WORKERS):
+    scraper = cloudscraper.create_scraper()
+    asset_session = create_asset_session(scraper, workers)
+    cache_file = output_root / ASSET_CACHE_FILE
+    asset_cache = load_asset_cache(cache_file, output_root)
+    seen_dirs: set[Path] = set()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            visited_pages = crawl_pages(scraper, asset_session, executor, asset_cache, seen_dirs, start_url, output_root, max_pages, follow_prefix)
+    except BaseException:
+        # Keep what was downloaded before the crawl stopped, but never let a
+        # failed save mask the error that stopped it
+        try:
+            save_asset_cache(cache_file, asset_cache, output_root)
+        except Exception as exc:
+            print(f"Failed to save asset cache: {cache_file} -> {exc}")
+        raise
+    finally:
+        asset_session.close()
+    save_asset_cache(cache_file, asset_cache, output_root)
+    return visited_pages
 
 
-def crawl(start_url: str, output_root: Path, max_pages: int, follow_prefix: str | None):
-    scraper = cloudscraper.create_scraper()
+def crawl_pages(scraper, asset_session, executor, asset_cache: dict[str, Path | None], seen_dirs: set[Path], start_url: str, output_root: Path, max_pages: int, follow_prefix: str | None) -> set[str]:
     queue: deque[str] = deque([start_url])
     visited_pages: set[str] = set()
-    asset_cache: dict[str, Path] = {}
 
     while queue and len(visited_pages) < max_pages:
         current_url = queue.popleft()
@@ -161,102 +370,116 @@ def crawl(start_url: str, output_root: Path, max_pages: int, follow_prefix: str
             continue
         visited_pages.add(canon_current)
 
-        soup = BeautifulSoup(resp.text, "lxml")
-        for iframe in soup.find_all("iframe"):
-            iframe.decompose()
+        soup = parse_html(resp.text)
 
         page_local = url_to_local_path(canon_current, output_root)
-        ensure_parent(page_local)
-
-        # Collect links for further crawling and rewrite anchor hrefs
-        for a in soup.find_all("a"):
-            href = a.get("href")
-            canon_link = canonicalize(href, canon_current)
-            if not canon_link:
+        ensure_parent(page_local, seen_dirs)
+        page_parent = str(page_local.parent)
+
+        # Walk the tree once: rewrite anchors and forms in place, and bucket the
+        # tags that reference assets so they can all be fetched before rewriting
+        doomed = []
+        asset_refs: list[AssetRef] = []
+        styled_tags = []
+        style_strings = []
+        meta_tags = []
+        asset_urls: set[str] = set()
+        open_iframe = None
+        for tag in soup.descendants:
+            if not isinstance(tag, Tag):
                 continue
-            parsed = urlsplit(canon_link)
-            if parsed.netloc.endswith("pandora.net"):
-                if follow_prefix is None or parsed.path.startswith(follow_prefix):
-                    if canon_link not in visited_pages:
-                        queue.append(canon_link)
-                local_path = url_to_local_path(canon_link, output_root)
-                rel = os.path.relpath(local_path, page_local.parent)
-                a["href"] = rel
-
-        for form in soup.find_all("form"):
-            action = form.get("action")
-            canon_action = canonicalize(action, canon_current)
-            if not canon_action:
+            if open_iframe is not None:
+                # Anything nested in an iframe is dropped with it
+                if any(parent is open_iframe for parent in tag.parents):
+                    continue
+                open_iframe = None
+            tag_name = tag.name
+            if tag_name == "iframe":
+                doomed.append(tag)
+                open_iframe = tag
                 continue
-            parsed = urlsplit(canon_action)
-            if parsed.netloc.endswith("pandora.net"):
-                local_path = url_to_local_path(canon_action, output_root)
-                rel = os.path.relpath(local_path, page_local.parent)
-                form["action"] = rel
-
-        # Handle assets
-        for tag_name, attrs in ASSET_TAG_ATTRS.items():
-            for tag in soup.find_all(tag_name):
-                for attr in attrs:
-                    if attr in ("srcset", "data-srcset"):
-                        rewrite_srcset(scraper, tag, attr, canon_current, page_local, asset_cache, output_root)
-                    else:
-                        handle_asset(scraper, tag, attr, tag_name, canon_current, page_local, asset_cache, output_root)
+            if tag_name == "a":
+                # Collect links for further crawling and rewrite anchor hrefs
+                href = tag.get("href")
+                canon_link = canonicalize(href, canon_current) if may_be_internal(href) else None
+                if canon_link:
+                    parsed = urlsplit(canon_link)
+                    if parsed.netloc.endswith("pandora.net"):
+                        if follow_prefix is None or parsed.path.startswith(follow_prefix):
+                            if canon_link not in visited_pages:
+                                queue.append(canon_link)
+                        local_path = url_to_local_path(canon_link, output_root)
+                        tag["href"] = cached_relpath(str(local_path), page_parent)
+            elif tag_name == "form":
+                action = tag.get("action")
+                canon_action = canonicalize(action, canon_current) if may_be_internal(action) else None
+                if canon_action:
+                    parsed = urlsplit(canon_action)
+                    if parsed.netloc.endswith("pandora.net"):
+                        local_path = url_to_local_path(canon_action, output_root)
+                        tag["action"] = cached_relpath(str(local_path), page_parent)
+            elif tag_name == "style":
+                # Keep the NavigableString itself; blocks without url() never need rewriting
+                css = tag.string
+                if css and "url(" in css:
+                    style_strings.append(css)
+                    asset_urls.update(style_asset_urls(css))
+            elif tag_name == "meta":
+                content = tag.get("content")
+                if content and ABSOLUTE_URL_RE.match(content) is not None and should_localize(content):
+                    meta_tags.append(tag)
+                    asset_urls.add(content)
+            elif tag_name == "link" and is_hint_link(tag):
+                # preconnect/dns-prefetch hints point at hosts we no longer talk to
+                if canonicalize(tag.get("href"), canon_current):
+                    doomed.append(tag)
+            elif tag_name in ASSET_TAG_ATTRS:
+                for ref in asset_tag_refs(tag, tag_name, canon_current):
+                    asset_refs.append(ref)
+                    asset_urls.update(ref.urls())
+            if tag.attrs.get("style"):
+                styled_tags.append(tag)
+                asset_urls.update(style_asset_urls(tag["style"]))
+
+        # Decompose only after the walk so the iteration isn't disturbed
+        for tag in doomed:
+            tag.decompose()
+
+        # Fetch every asset on the page concurrently, then resolve each unique
+        # URL to its page-relative path once for all the rewrites below
+        prefetch_assets(executor, asset_session, asset_urls, output_root, asset_cache, seen_dirs)
+        url_to_rel = {
+            url: cached_relpath(str(asset_cache[url]), page_parent)
+            for url in asset_urls
+            if asset_cache.get(url)
+        }
+        # One url() replacer per page, shared by every style attribute and block
+        replace_style = partial(replace_style_url, url_to_rel=url_to_rel)
+
+        # Point asset attributes at the downloaded copies
+        for ref in asset_refs:
+            apply_asset_ref(ref, url_to_rel)
 
         # Inline style attributes with url()
-        for tag in soup.find_all(style=True):
-            style_value = tag.get("style")
-            if not style_value:
-                continue
-            changed = False
-
-            def replace_match(match: re.Match) -> str:
-                nonlocal changed
-                url = match.group(2)
-                rel = localize_url(scraper, url, page_local, asset_cache, output_root)
-                if rel:
-                    changed = True
-                    quote = match.group(1)
-                    return f"url({quote}{rel}{quote})"
-                return match.group(0)
-
-            new_style = URL_IN_STYLE_RE.sub(replace_match, style_value)
+        for tag in styled_tags:
+            new_style, changed = localize_style_text(tag["style"], replace_style)
             if changed:
                 tag["style"] = new_style
 
         # <style> tag contents
-        for style_tag in soup.find_all("style"):
-            if not style_tag.string:
-                continue
-            text = style_tag.string
-            changed = False
-
-            def replace_match(match: re.Match) -> str:
-                nonlocal changed
-                url = match.group(2)
-                rel = localize_url(scraper, url, page_local, asset_cache, output_root)
-                if rel:
-                    changed = True
-                    quote = match.group(1)
-                    return f"url({quote}{rel}{quote})"
-                return match.group(0)
-
-            updated = URL_IN_STYLE_RE.sub(replace_match, text)
+        for css in style_strings:
+            updated, changed = localize_style_text(css, replace_style)
             if changed:
-                style_tag.string.replace_with(updated)
+                css.replace_with(updated)
 
         # Meta tags with URLs we want to localise
-        for meta in soup.find_all("meta"):
+        for meta in meta_tags:
             content = meta.get("content")
-            if not content or not content.startswith("http"):
-                continue
-            rel = localize_url(scraper, content, page_local, asset_cache, output_root)
+            rel = localize_url(content, url_to_rel)
             if rel:
                 meta["content"] = rel
 
-        html_bytes = soup.prettify("utf-8")
-        with open(page_local, "wb") as fh:
-            fh.write(html_bytes)
+        page_local.write_bytes(soup.encode("utf-8", formatter="minimal"))
 
     return visited_pages
 
@@ -267,10 +490,11 @@ def main():
     parser.add_argument("--output", default="site", help="Output directory")
     parser.add_argument("--max-pages", type=int, default=30, help="Maximum pages to crawl")
     parser.add_argument("--follow-prefix", default="/en/", help="Path prefix to follow for internal links")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Concurrent asset downloads")
     args = parser.parse_args()
 
     output_root = Path(args.output).resolve()
-    visited = crawl(args.start_url, output_root, args.max_pages, args.follow_prefix)
+    visited = crawl(args.start_url, output_root, args.max_pages, args.follow_prefix, args.workers)
     print(f"Downloaded {len(visited)} pages to {output_root}")
 
 
@@ -2,7 +2,7 @@
 """Scrape YouTube shorts for a channel handle and emit JSON.
 
 The script performs a simple HTTP GET on the shorts tab for a channel handle,
-parses the embedded ``ytInitialData`` payload, and extracts unique video IDs.
+scans the embedded ``ytInitialData`` payload, and extracts unique video IDs.
 
 Usage:
 
@@ -15,6 +15,7 @@ from __future__ import annotations
 
 import argparse
 import json
+import re
 from collections import deque
 from pathlib import Path
 from typing import Iterable, List
@@ -23,6 +24,7 @@ import requests
 
 
 SHORT_URL_TEMPLATE = "https://www.youtube.com/shorts/{video_id}"
+VIDEO_ID_RE = re.compile(r'"reelWatchEndpoint":\{"videoId":"([A-Za-z0-9_-]{11})"')
 
 
 def fetch_shorts_page(handle: str) -> str:
@@ -54,27 +56,38 @@ def extract_ytinitialdata(html: str) -> dict:
     if start == -1:
         raise ValueError("Malformed ytInitialData payload")
 
-    depth = 0
-    for idx in range(start, len(html)):
-        char = html[idx]
-        if char == "{":
-            depth += 1
-        elif char == "}":
-            depth -= 1
-            if depth == 0:
-                end = idx + 1
-                break
-    else:
-        raise ValueError("Failed to determine end of ytInitialData payload")
-
-    json_blob = html[start:end]
-    return json.loads(json_blob)
+    # ``raw_decode`` parses in C and stops at the end of the object, so
+    # trailing script content is ignored and braces inside strings are safe.
+    try:
+        data, _ = json.JSONDecoder().raw_decode(html, start)
+    except json.JSONDecodeError as exc:
+        raise ValueError("Failed to decode ytInitialData payload") from exc
+    return data
 
 
 def extract_video_ids(html: str, limit: int | None = 50) -> List[str]:
     """Extract unique shorts video IDs from the YouTube HTML payload."""
 
-    data = extract_ytinitialdata(html)
+    # Fast path: scan the raw HTML for endpoints without materialising the
+    # full ``ytInitialData`` object graph.
+    seen = set()
+    ordered: List[str] = []
+    for match in VIDEO_ID_RE.finditer(html):
+        video_id = match.group(1)
+        if video_id not in seen:
+            seen.add(video_id)
+            ordered.append(video_id)
+            if limit and len(ordered) >= limit:
+                break
+    if ordered:
+        return ordered
+
+    return _walk_video_ids(extract_ytinitialdata(html), limit)
+
+
+def _walk_video_ids(data: dict, limit: int | None) -> List[str]:
+    """Fallback that walks the decoded payload for ``reelWatchEndpoint`` ids."""
+
     seen = set()
     ordered: List[str] = []
     queue = deque([data])